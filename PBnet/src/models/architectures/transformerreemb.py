@@ -3,25 +3,47 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange, repeat, reduce, pack, unpack
-from einops_exts import rearrange_many
 from torch import einsum
 from rotary_embedding_torch import RotaryEmbedding
 import math 
 
+# F.scaled_dot_product_attention (flash / mem-efficient kernels) only exists from torch 2.0
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+# let the matmuls left in fp32 (outside autocast) use TF32 tensor cores
+torch.backends.cuda.matmul.allow_tf32 = True
+
 
 def exists(x):
     return x is not None
 
+def compile_module(module, enabled=True):
+    # nn.Module.compile (torch >= 2.2) compiles in place, so state_dict keys stay the same
+    if enabled and hasattr(module, 'compile'):
+        module.compile(dynamic=True)
+    return module
+
+def padding_bias(mask, dtype):
+    # bool frame mask (True = valid) -> additive float mask (0 / -inf); float masks keep
+    # nn.Transformer* on the same path as the float attention masks instead of a bool merge
+    return torch.zeros(mask.shape, device=mask.device, dtype=dtype).masked_fill_(~mask, float('-inf'))
+
+def autocast_bf16(x):
+    # bf16 autocast for the encoder/decoder bodies on GPUs that support it, a no-op otherwise
+    enabled = x.is_cuda and torch.cuda.is_bf16_supported()
+    return torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=enabled)
+
 class LayerNorm(nn.Module):
     def __init__(self, dim, eps=1e-5):
         super().__init__()
         self.eps = eps
+        self.dim = dim
         self.gamma = nn.Parameter(torch.ones(1, 1,  dim))
 
     def forward(self, x):
-        var = torch.var(x, dim=-1, unbiased=False, keepdim=True)
-        mean = torch.mean(x, dim=-1, keepdim=True)
-        return (x - mean) / (var + self.eps).sqrt() * self.gamma
+        # fused kernel, same result as (x - mean) / sqrt(var + eps) * gamma
+        # gamma keeps its (1, 1, dim) shape so existing checkpoints still load
+        return F.layer_norm(x, (self.dim,), weight=self.gamma.view(-1), bias=None, eps=self.eps)
 
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
@@ -48,12 +70,17 @@ class EinopsToAndFrom(nn.Module):
         self.to_einops = to_einops
         self.fn = fn
 
+        # only plain axis permutations are used here, so do them with a native permute
+        # instead of einops (parsed on every call and a graph break under torch.compile)
+        from_axes, to_axes = from_einops.split(' '), to_einops.split(' ')
+        assert sorted(from_axes) == sorted(to_axes), 'EinopsToAndFrom only supports axis permutations'
+        self.perm = tuple(from_axes.index(axis) for axis in to_axes)
+        self.inv_perm = tuple(to_axes.index(axis) for axis in from_axes)
+
     def forward(self, x, **kwargs):
-        shape = x.shape
-        reconstitute_kwargs = dict(tuple(zip(self.from_einops.split(' '), shape)))
-        x = rearrange(x, f'{self.from_einops} -> {self.to_einops}')
+        x = x.permute(self.perm)
         x = self.fn(x, **kwargs)
-        x = rearrange(x, f'{self.to_einops} -> {self.from_einops}', **reconstitute_kwargs)
+        x = x.permute(self.inv_perm)
         return x
 
 class Attention(nn.Module):
@@ -73,6 +100,14 @@ class Attention(nn.Module):
         self.to_qkv = nn.Linear(dim, hidden_dim * 3, bias=False)
         self.to_out = nn.Linear(hidden_dim, dim, bias=False)
 
+        # off-diagonal mask for the focus-present path, built on first use for a given n
+        self.register_buffer('_offdiag_mask', None, persistent=False)
+
+    def _offdiag(self, n, device):
+        if self._offdiag_mask is None or self._offdiag_mask.shape[-1] != n or self._offdiag_mask.device != device:
+            self._offdiag_mask = ~torch.eye(n, device=device, dtype=torch.bool)
+        return self._offdiag_mask
+
     def forward(
             self,
             x,
@@ -81,78 +116,102 @@ class Attention(nn.Module):
     ):  # temperal: 'b (h w) f c'  ; spatial :  'b f (h w) c'
         n, device = x.shape[-2], x.device
 
-        qkv = self.to_qkv(x).chunk(3, dim=-1)
+        # one projection split straight into q, k, v and heads: ..., n, 3, h, d
+        qkv = self.to_qkv(x).unflatten(-1, (3, self.heads, -1))
 
         if exists(focus_present_mask) and focus_present_mask.all():
             # if all batch samples are focusing on present
             # it would be equivalent to passing that token's values through to the output
-            values = qkv[-1]
+            values = qkv[..., 2, :, :].flatten(-2)
             return self.to_out(values)
 
-        # split out heads
-
-        q, k, v = rearrange_many(qkv, '... n (h d) -> ... h n d', h=self.heads)
+        # (..., n, 3, h, d) -> (3, ..., h, n, d) in a single copy, so every head is a contiguous
+        # (n, d) block, the layout the batched matmul expects; q, k, v are then plain unbind views
 
-        # scale
-
-        q = q * self.scale
+        qkv = qkv.movedim(-3, 0).transpose(-2, -3).contiguous()
 
         # rotate positions into queries and keys for time attention
+        # q and k are rotated together in one call, so the cos/sin table is applied once
 
         if exists(self.rotary_emb):
-            q = self.rotary_emb.rotate_queries_or_keys(q)
-            k = self.rotary_emb.rotate_queries_or_keys(k)
+            q, k = self.rotary_emb.rotate_queries_or_keys(qkv[:2]).unbind(0)
+            v = qkv[2]
+        else:
+            q, k, v = qkv.unbind(0)
 
-        # similarity
+        # relative positional bias and focus-present mask, folded into one additive bias
 
-        sim = einsum('... h i d, ... h j d -> ... h i j', q, k)
+        attn_bias = pos_bias
 
-        # relative positional bias
+        if exists(focus_present_mask) and not (~focus_present_mask).all():
+            # samples focusing on the present only attend to themselves: everything off the diagonal is masked
+            masked = focus_present_mask.view(-1, 1, 1, 1, 1) & self._offdiag(n, device)
+            fill = torch.tensor(-torch.finfo(q.dtype).max, device=device, dtype=q.dtype)
+            attn_bias = torch.where(masked, fill, attn_bias if exists(attn_bias) else torch.zeros_like(fill))
+
+        if HAS_SDPA:
+            # scaling, softmax and the value aggregation are fused, the n x n matrix is never stored
+            if exists(attn_bias):
+                attn_bias = attn_bias.to(q.dtype)
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias, dropout_p=0.0)
+        else:
+            # flatten the leading dims into one batch so both matmuls are single (b)bmm calls;
+            # the scale and the additive bias are applied inside the first GEMM
 
-        if exists(pos_bias):
-            sim = sim + pos_bias
+            lead = q.shape[:-2]
+            q, k, v = (t.reshape(-1, n, t.shape[-1]) for t in (q, k, v))
 
-        if exists(focus_present_mask) and not (~focus_present_mask).all():
-            attend_all_mask = torch.ones((n, n), device=device, dtype=torch.bool)
-            attend_self_mask = torch.eye(n, device=device, dtype=torch.bool)
+            # similarity
 
-            mask = torch.where(
-                rearrange(focus_present_mask, 'b -> b 1 1 1 1'),
-                rearrange(attend_self_mask, 'i j -> 1 1 1 i j'),
-                rearrange(attend_all_mask, 'i j -> 1 1 1 i j'),
-            )
+            if exists(attn_bias):
+                bias = attn_bias.expand(*lead, n, n).reshape(-1, n, n).to(q.dtype)
+                sim = torch.baddbmm(bias, q, k.transpose(-1, -2), alpha=self.scale)
+            else:
+                sim = torch.bmm(q, k.transpose(-1, -2)).mul_(self.scale)
 
-            sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+            # softmax already subtracts the row max internally, no separate stabilizer pass needed
 
-        # numerical stability
+            attn = sim.softmax(dim=-1)
 
-        sim = sim - sim.amax(dim=-1, keepdim=True).detach()
-        attn = sim.softmax(dim=-1)
+            # aggregate values
 
-        # aggregate values
+            out = torch.bmm(attn, v).view(*lead, n, -1)
 
-        out = einsum('... h i j, ... h j d -> ... h i d', attn, v)
-        out = rearrange(out, '... h n d -> ... n (h d)')
+        out = out.transpose(-2, -3).contiguous().flatten(-2)
         return self.to_out(out)
 
 class PositionalEncoding(nn.Module):
-    def __init__(self, d_model, dropout=0.1, max_len=20000):
+    def __init__(self, d_model, dropout=0.1, max_len=20000, batch_first=False):
         super(PositionalEncoding, self).__init__()
         self.dropout = nn.Dropout(p=dropout)
+        self.batch_first = batch_first
 
         pe = torch.zeros(max_len, d_model)
         position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-np.log(10000.0) / d_model))
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
+        pe = pe.unsqueeze(0).transpose(0, 1).contiguous() # max_len, 1, d_model
         
         self.register_buffer('pe', pe)
+        # copies of pe in other (device, dtype) pairs, e.g. bf16 under autocast, built once on first use
+        self._cache = {}
+
+    def _pe_for(self, x):
+        if x.device == self.pe.device and x.dtype == self.pe.dtype:
+            return self.pe
+        key = (x.device, x.dtype)
+        if key not in self._cache:
+            self._cache[key] = self.pe.to(device=x.device, dtype=x.dtype)
+        return self._cache[key]
 
     def forward(self, x):
-        # not used in the final model
-        x = x + self.pe[:x.shape[0], :]
-        return self.dropout(x)
+        # x: len, bs, d_model (bs, len, d_model if batch_first)
+        # added in place: callers pass a fresh activation, and pe is a buffer
+        pe = self._pe_for(x)
+        if self.batch_first:
+            return self.dropout(x.add_(pe[:x.size(1)].transpose(0, 1)))
+        return self.dropout(x.add_(pe[:x.size(0)]))
 
 
 class RelativePositionBias(nn.Module):
@@ -167,6 +226,24 @@ class RelativePositionBias(nn.Module):
         self.max_distance = max_distance
         self.relative_attention_bias = nn.Embedding(num_buckets, heads)
 
+        # bucket indices and the long-distance mask only depend on n (not on the weights),
+        # so they are built once and reused; non-persistent buffers follow .to(device)
+        self.register_buffer('_rp_bucket', None, persistent=False)
+        self.register_buffer('_rp_mask', None, persistent=False)
+        self._rp_key = None
+
+        # full (heads, n, n) bias folded once for inference, see prepare_for_inference
+        self.register_buffer('_frozen_bias', None, persistent=False)
+        self._frozen_key = None
+
+        # the bucket is a pure function of the relative position and saturates once
+        # |rel_pos| >= max_distance, so a lookup table over [-max_distance, max_distance]
+        # (indexed with the clamped relative position) covers every sequence length
+        rel_range = torch.arange(-max_distance, max_distance + 1, dtype=torch.long)
+        self.register_buffer('_rp_lut', self._relative_position_bucket(rel_range, num_buckets=num_buckets,
+                                                                       max_distance=max_distance),
+                             persistent=False)
+
     @staticmethod
     def _relative_position_bucket(relative_position, num_buckets=32, max_distance=128):
         ret = 0
@@ -187,19 +264,46 @@ class RelativePositionBias(nn.Module):
         ret += torch.where(is_small, n, val_if_large)
         return ret
 
+    def _bucket_and_mask(self, n, device):
+        if self._rp_key != (n, device) or self._rp_bucket is None:
+            q_pos = torch.arange(n, dtype=torch.long, device=device)
+            k_pos = torch.arange(n, dtype=torch.long, device=device)
+            rel_pos = k_pos[None, :] - q_pos[:, None]
+            self._rp_bucket = self._rp_lut.to(device)[rel_pos.clamp(-self.max_distance, self.max_distance) + self.max_distance]
+            self._rp_mask = - (((rel_pos > 32) + (rel_pos  < -32)) * (1e8))
+            self._rp_key = (n, device)
+        return self._rp_bucket, self._rp_mask
+
+    def train(self, mode=True):
+        self._frozen_bias = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._frozen_bias = None
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    @torch.no_grad()
+    def prepare_for_inference(self, n, device):
+        # in eval the bias only depends on the (fixed) embedding weights and n, so compute it once;
+        # it is dropped again by train() and by loading a state dict
+        self._frozen_bias = self._bias(n, device)
+        self._frozen_key = (n, device)
+
     def forward(self, n, device, eval = False):
-        q_pos = torch.arange(n, dtype=torch.long, device=device)
-        k_pos = torch.arange(n, dtype=torch.long, device=device)
-        rel_pos = rearrange(k_pos, 'j -> 1 j') - rearrange(q_pos, 'i -> i 1')
-        rp_bucket = self._relative_position_bucket(rel_pos, num_buckets=self.num_buckets,
-                                                   max_distance=self.max_distance)
+        if not self.training:
+            if self._frozen_bias is None or self._frozen_key != (n, device):
+                self.prepare_for_inference(n, device)
+            return self._frozen_bias
+        return self._bias(n, device)
+
+    def _bias(self, n, device):
+        rp_bucket, mask = self._bucket_and_mask(n, device)
         if True:
-            mask = - (((rel_pos > 32) + (rel_pos  < -32)) * (1e8))
             values = self.relative_attention_bias(rp_bucket)
-            return rearrange(values, 'i j h -> h i j') + mask
+            return values.permute(2, 0, 1) + mask
         else:
             values = self.relative_attention_bias(rp_bucket)
-            return rearrange(values, 'i j h -> h i j')
+            return values.permute(2, 0, 1)
         
 # only for ablation / not used in the final model
 class TimeEncoding(nn.Module):
@@ -219,7 +323,7 @@ class TimeEncoding(nn.Module):
 class Encoder_TRANSFORMERREEMB(nn.Module):
     def __init__(self, modeltype, num_frames, audio_dim=1024, pos_dim=7, pose_latent_dim=64,
                  audio_latent_dim=256, ff_size=1024, num_layers=4, num_heads=4, dropout=0.1,
-                 ablation=None, activation="gelu", **kargs):
+                 ablation=None, activation="gelu", use_compile=True, **kargs):
         super().__init__()
         
         self.modeltype = modeltype
@@ -255,49 +359,62 @@ class Encoder_TRANSFORMERREEMB(nn.Module):
         self.firstposeEmbedding = nn.Linear(self.pos_dim, self.pose_latent_dim) #6,64
         self.audioEmbedding = nn.Linear(self.audio_dim, self.audio_latent_dim) #1024, 256
         
-        self.sequence_pos_encoder = PositionalEncoding(self.latent_dim, self.dropout)
+        self.sequence_pos_encoder = PositionalEncoding(self.latent_dim, self.dropout, batch_first=True)
         
         # self.pos_embedding = nn.Parameter(torch.randn(1, num_patches + 1, dim))
         
+        # batch_first lets nn.TransformerEncoder take its fused inference fast path
         seqTransEncoderLayer = nn.TransformerEncoderLayer(d_model=self.latent_dim,
                                                           nhead=self.num_heads,
                                                           dim_feedforward=self.ff_size,
                                                           dropout=self.dropout,
-                                                          activation=self.activation)
+                                                          activation=self.activation,
+                                                          batch_first=True)
+        # no nested tensors: they zero the padded frames, which the decoder still reads through z
         self.seqTransEncoder = nn.TransformerEncoder(seqTransEncoderLayer,
-                                                     num_layers=self.num_layers)
+                                                     num_layers=self.num_layers,
+                                                     enable_nested_tensor=False)
+        compile_module(self.seqTransEncoder, use_compile)
+
+    def _fused_embedding_params(self):
+        # the three embeddings see disjoint slices of the input, so they stack into one block-diagonal
+        # weight; it is assembled from the original Linears so the checkpoint layout is unchanged
+        embeddings = (self.firstposeEmbedding, self.poseEmbedding, self.audioEmbedding)
+        weight = torch.block_diag(*(embedding.weight for embedding in embeddings))
+        bias = torch.cat([embedding.bias for embedding in embeddings])
+        return weight, bias
 
     def forward(self, batch):
         '''
             x: 6-dim pos, (bs, max_num_frames, 6)
             y: 1024-dim audio embbeding, (bs, max_num_frames, 1024)
         '''
+        with autocast_bf16(batch["x"]):
+            out = self._forward(batch)
+        # back to fp32 for the reparameterization and the KL loss
+        return {"mu": out["mu"].float(), "logvar": out["logvar"].float()}
 
+    def _forward(self, batch):
         x, y, mask = batch["x"], batch["y"], batch["mask"]
         # bs, njoints, nfeats, nframes = x.shape
         # x = x.permute((3, 0, 1, 2)).reshape(nframes, bs, njoints*nfeats) 
         x_ref = x[:,0,:].unsqueeze(dim=1) # The pose information of the first frame(refrence img)
-        x = x-x_ref.repeat(1,x.size(1),1) # bs, nf, 6  Obtain the difference from the first frame
+        x = x-x_ref # bs, nf, 6  Obtain the difference from the first frame (broadcast over nf)
         batch['x_delta'] = x
-        x_ref = x_ref.permute((1,0,2)) #1, bs, 6
-        x = x.permute((1, 0, 2)) #nf, bs, 6
-        y = y.permute((1, 0, 2)) #nf, bs, 1024
-        # embedding of the pose/audio
-        x_ref = self.firstposeEmbedding(x_ref).repeat(x.size(0),1,1) #nf, bs, 64
-        x = self.poseEmbedding(x) #nf, bs, 64
-        y = self.audioEmbedding(y) #nf, bs, 256
-        x = torch.cat([x_ref, x, y],dim=-1) # nf, bs, 64+64+256
+        # embedding of the pose/audio, as a single GEMM over the concatenated inputs
+        x = torch.cat([x_ref.expand(-1,x.size(1),-1), x, y],dim=-1) # bs, nf, 6+6+1024
+        x = F.linear(x, *self._fused_embedding_params()) # bs, nf, 64+64+256
 
         # only use the "average_encoder" mode
         # add positional encoding
         x = self.sequence_pos_encoder(x)
         # transformer layers
-        final = self.seqTransEncoder(x, src_key_padding_mask=~mask) #nu_frames, bs, 64+64+256
+        final = self.seqTransEncoder(x, src_key_padding_mask=padding_bias(mask, x.dtype)) #bs, nu_frames, 64+64+256
         # get the average of the output
-        z = final# final.mean(axis=0) # nf, bs, 64+64+256
-        # extract mu and logvar
-        mu = self.mu_layer(z) # nf, bs, 256
-        logvar = self.sigma_layer(z) # nf, bs, 256
+        z = final# final.mean(axis=0) # bs, nf, 64+64+256
+        # extract mu and logvar, returned as nf, bs, 256 like the latents the sampling code draws
+        mu = self.mu_layer(z).transpose(0, 1) # nf, bs, 256
+        logvar = self.sigma_layer(z).transpose(0, 1) # nf, bs, 256
         # logvar = - torch.ones_like(logvar) * 1e10
 
         return {"mu": mu, "logvar": logvar}
@@ -306,7 +423,7 @@ class Encoder_TRANSFORMERREEMB(nn.Module):
 class Decoder_TRANSFORMERREEMB(nn.Module):
     def __init__(self, modeltype, num_frames, audio_dim=1024, pos_dim=7, pose_latent_dim=64,
                  audio_latent_dim=256, ff_size=1024, num_layers=4, num_heads=4, dropout=0.1, activation="gelu",
-                 ablation=None, num_buckets = 32, max_distance = 32,**kargs):
+                 ablation=None, num_buckets = 32, max_distance = 32, use_compile=True, **kargs):
         super().__init__()
 
         self.modeltype = modeltype
@@ -348,14 +465,21 @@ class Decoder_TRANSFORMERREEMB(nn.Module):
         # else:
         #     self.sequence_pos_encoder = PositionalEncoding(self.latent_dim, self.dropout)
 
-        self.sequence_pos_encoder = PositionalEncoding(self.pose_latent_dim, self.dropout)
+        self.sequence_pos_encoder = PositionalEncoding(self.pose_latent_dim, self.dropout, batch_first=True)
         rotary_emb = RotaryEmbedding(min(32, num_heads))
+        # fill the rotary cos/sin cache for num_frames up front, so steady-state calls never
+        # rebuild it; its cache is a plain dict that does not follow .to(), so only warm it
+        # on the device the model is going to be used on
+        if "device" in kargs:
+            with torch.no_grad():
+                rotary_emb.rotate_queries_or_keys(torch.zeros(1, num_frames, 32, device=kargs["device"]))
 
         self.time_rel_pos_bias = RelativePositionBias(heads=num_heads,
                                                       num_buckets=num_buckets,
                                                       max_distance=max_distance)  
 
-        temporal_attn = lambda dim: EinopsToAndFrom('l b c', 'b l c',  # len, b, c
+        # the time queries are already b, l, c; the wrapper stays so checkpoint keys are unchanged
+        temporal_attn = lambda dim: EinopsToAndFrom('b l c', 'b l c',
                                                     Attention(dim, heads=num_heads, dim_head=32,
                                                               rotary_emb=rotary_emb))
 
@@ -366,12 +490,44 @@ class Decoder_TRANSFORMERREEMB(nn.Module):
                                                           nhead=self.num_heads,
                                                           dim_feedforward=self.ff_size,
                                                           dropout=self.dropout,
-                                                          activation=activation)
+                                                          activation=activation,
+                                                          batch_first=True)
         self.seqTransDecoder = nn.TransformerDecoder(seqTransDecoderLayer,
                                                      num_layers=self.num_layers)
+        compile_module(self.init_temporal_attn, use_compile)
+        compile_module(self.seqTransDecoder, use_compile)
         
         self.finallayer = nn.Linear(self.pose_latent_dim, self.pos_dim)
-        
+
+        # eval-only cache of init_proj(pe), see _time_queries
+        self.register_buffer('_tq_base', None, persistent=False)
+
+    def train(self, mode=True):
+        # init_proj is about to change (or has just been trained), drop the cached time queries
+        self._tq_base = None
+        super().train(mode)
+        if not mode:
+            device = self.time_rel_pos_bias.relative_attention_bias.weight.device
+            self.time_rel_pos_bias.prepare_for_inference(self.num_frames, device)
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._tq_base = None
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def _time_queries(self, bs, nframes, device):
+        if self.training:
+            timequeries = torch.zeros(bs, nframes, self.pose_latent_dim, device=device) # b, len, c
+            timequeries = self.sequence_pos_encoder(timequeries)
+            return self.init_proj(timequeries)
+        # without dropout the queries are the same for every sample and every call:
+        # project the positional encoding once (in fp32) and hand out a 1, len, c slice
+        if self._tq_base is None or self._tq_base.shape[1] < nframes or self._tq_base.device != device:
+            with torch.no_grad(), torch.autocast(device_type=device.type, enabled=False):
+                timequeries = torch.zeros(1, max(nframes, self.num_frames), self.pose_latent_dim, device=device)
+                self._tq_base = self.init_proj(self.sequence_pos_encoder(timequeries))
+        return self._tq_base[:, :nframes]
+
     def forward(self, batch):
         '''
             z: bs, audio_latent_dim(256)
@@ -379,17 +535,22 @@ class Decoder_TRANSFORMERREEMB(nn.Module):
             mask: bs, num_frames
             lengths: [num_frames,...]
         '''
+        with autocast_bf16(batch["x"]):
+            batch = self._forward(batch)
+        batch["output"] = batch["output"].float()
+        return batch
+
+    def _forward(self, batch):
         x, z, y, mask, lengths = batch["x"], batch["z"], batch["y"], batch["mask"], batch["lengths"]
         bs, nframes = mask.shape
         # first img
         x_ref = x[:,0,:].unsqueeze(dim=1) #bs, 1, 64
-        x_ref = self.firstposeEmbedding(x_ref.repeat(1, nframes, 1)) #bs, nf, 64
+        x_ref = self.firstposeEmbedding(x_ref).expand(-1, nframes, -1) #bs, nf, 64  embed once, then a stride-0 view
         y = self.audioEmbedding(y) #bs, num_frames, 256
         z = z.permute(1, 0, 2)
         #z = z.unsqueeze(dim=1).repeat(1, nframes, 1) #bs, num_frames, 256
         z = torch.cat([x_ref, z, y], dim=-1) # bs, num_frames, 256*2+64
-        z = self.ztimelinear(z)
-        z = z.permute((1, 0, 2)) # nf, bs, 64
+        z = self.ztimelinear(z) # bs, nf, 64
         pose_latent_dim = z.shape[2]
         # z = z[None]  # sequence of size 1
 
@@ -409,14 +570,14 @@ class Decoder_TRANSFORMERREEMB(nn.Module):
         #         z = z + self.actionBiases[y.long()] # NEED CHECK
         #         z = z[None]  # sequence of size 1
             
-        timequeries = torch.zeros(nframes, bs, pose_latent_dim, device=z.device) # len, b, c
-        timequeries = self.sequence_pos_encoder(timequeries)
-
-        time_rel_pos_bias = self.time_rel_pos_bias(timequeries.shape[0], device=x.device)
+        timequeries = self._time_queries(bs, nframes, z.device) # b (1 in eval), len, c
 
-        timequeries = self.init_proj(timequeries)
+        time_rel_pos_bias = self.time_rel_pos_bias(nframes, device=x.device)
 
         timequeries = self.init_temporal_attn(timequeries, pos_bias=time_rel_pos_bias)
+        # materialize the batch once here, otherwise the first decoder layer's projections
+        # each copy the stride-0 expand implicitly
+        timequeries = timequeries.expand(bs, -1, -1).contiguous()
 
         # timequeries = self.sequence_pos_encoder(timequeries, mask, lengths) #time_encoding
         
@@ -426,16 +587,19 @@ class Decoder_TRANSFORMERREEMB(nn.Module):
         # else:
         #     timequeries = self.sequence_pos_encoder(timequeries)
         
-        # num_frames, bs, 64
-        output = self.seqTransDecoder(tgt=timequeries, memory=z, tgt_mask=time_rel_pos_bias.repeat(bs, 1, 1),
-                                      tgt_key_padding_mask=~mask)
+        # the key padding mask is added straight into the per-sample relative position bias
+        # (bs*heads, nf, nf), which is what attention would merge it into anyway
+        tgt_mask = time_rel_pos_bias[None] + padding_bias(mask, time_rel_pos_bias.dtype)[:, None, None, :]
+        tgt_mask = tgt_mask.reshape(-1, nframes, nframes).to(timequeries.dtype)
+
+        # bs, num_frames, 64
+        output = self.seqTransDecoder(tgt=timequeries, memory=z, tgt_mask=tgt_mask)
         
-        output = self.finallayer(output).reshape(nframes, bs, self.pos_dim) # num_frames, bs, 6
+        output = self.finallayer(output).reshape(bs, nframes, self.pos_dim) # bs, num_frames, 6
         # output = self.finallayer(output).reshape(nframes, bs, njoints, nfeats)
         
         # zero for padded area
-        output[~mask.T] = 0 #nf, bs, 6
-        output = output.permute(1,0,2)#bs, nf, 6
+        output = output * mask.unsqueeze(-1).to(output.dtype) #bs, nf, 6
         
         batch["output"] = output
         return batch